@@ -0,0 +1,33 @@
+"""
+Compares the time Typogrify takes with math hidden behind placeholders
+(the typogrify_placeholders setting) against ignoring math through
+TYPOGRIFY_IGNORE_TAGS, on a math heavy page.
+
+Run with: python benchmark_typogrify.py
+"""
+import time
+
+from typogrify.filters import typogrify
+from render_math import typogrify_with_placeholders
+
+PARAGRAPH = ('<p>Paragraph %d says "hello" & NASA -- <span class="math">\\(x_%d "a"\\)</span>, '
+             '<span class="math">\\(y\\)</span>\'s value and <span class="math">\\(E = MC^2\\)</span> '
+             'ends here.</p>')
+
+def fastest(filter, text, ignore_tags, runs=5):
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        filter(text, ignore_tags)
+        timings.append(time.time() - start)
+    return min(timings)
+
+if __name__ == '__main__':
+    typogrify_math = typogrify_with_placeholders(typogrify)
+    ignore_tags = ['.math', 'script']
+    text = '\n'.join(PARAGRAPH % (i, i) for i in range(1500))
+
+    for name, page in (('math only', text), ('math and kbd', text + '<p><kbd>Ctrl</kbd></p>')):
+        assert typogrify_math(page, ignore_tags) == typogrify(page, ignore_tags)
+        print('%-12s  ignore tags %.3fs  placeholders %.3fs' % (
+            name, fastest(typogrify, page, ignore_tags), fastest(typogrify_math, page, ignore_tags)))
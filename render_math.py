@@ -32,6 +32,8 @@ the math.  See README for more details.
 
 import collections
 import os
+import re
+import shutil
 import sys
 
 from pelican import signals, generators
@@ -73,9 +75,15 @@ def process_settings(pelicanobj):
     mathjax_settings['force_tls'] = 'false'  # will force mathjax to be served by https - if set as False, it will only use https if site is served using https
     mathjax_settings['message_style'] = 'normal'  # This value controls the verbosity of the messages in the lower left-hand corner. Set it to "none" to eliminate all messages
     mathjax_settings['macros'] = '{}'
+    mathjax_settings['version'] = 2  # major version of MathJax to generate the script for (values can be: 2, 3)
+    mathjax_settings['local_source'] = None  # absolute path of a locally installed MathJax 3 (its es5 directory). If set, the components that are used are copied into the output
+    mathjax_settings['tex_components'] = ['noerrors']  # MathJax 3 TeX extensions that need loading (see _tex_component)
+    mathjax_settings['lazy'] = 'false'  # if set to true, math is typeset as it nears the viewport (and when the browser is idle) instead of all at once on load
+    mathjax_settings['lazy_batch_size'] = '50'  # maximum number of math elements typeset per idle callback in lazy mode
+    mathjax_settings['typogrify_placeholders'] = False  # if set to true, math and scripts are swapped for placeholders while Typogrify runs instead of using TYPOGRIFY_IGNORE_TAGS
 
     # Source for MathJax
-    mathjax_settings['source'] = "'//cdn.mathjax.org/mathjax/latest/MathJax.js?config=TeX-AMS-MML_HTMLorMML'"
+    mathjax_settings['source'] = "'//cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.9/MathJax.js?config=TeX-AMS-MML_HTMLorMML'"
 
     # Get the user specified settings
     try:
@@ -87,6 +95,8 @@ def process_settings(pelicanobj):
     if not isinstance(settings, dict):
         return mathjax_settings
 
+    tex_extensions = []
+
     # The following mathjax settings can be set via the settings dictionary
     for key, value in ((key, settings[key]) for key in settings):
         # Iterate over dictionary in a way that is compatible with both version 2
@@ -153,6 +163,15 @@ def process_settings(pelicanobj):
 
             mathjax_settings[key] = value
 
+        if key == 'lazy' and isinstance(value, bool):
+            mathjax_settings[key] = 'true' if value else 'false'
+
+        if key == 'lazy_batch_size' and isinstance(value, int) and value > 0:
+            mathjax_settings[key] = str(value)
+
+        if key == 'typogrify_placeholders' and isinstance(value, bool):
+            mathjax_settings[key] = value
+
         if key == 'responsive' and isinstance(value, bool):
             mathjax_settings[key] = 'true' if value else 'false'
 
@@ -165,10 +184,11 @@ def process_settings(pelicanobj):
         if key == 'tex_extensions' and isinstance(value, list):
             # filter string values, then add '' to them
             try:
-                value = filter(lambda string: isinstance(string, basestring), value)
+                value = list(filter(lambda string: isinstance(string, basestring), value))
             except NameError:
-                value = filter(lambda string: isinstance(string, str), value)
+                value = list(filter(lambda string: isinstance(string, str), value))
 
+            tex_extensions = value
             value = map(lambda string: "'%s'" % string, value)
             mathjax_settings[key] = ',' + ','.join(value)
 
@@ -205,8 +225,73 @@ def process_settings(pelicanobj):
                     text_lines.append("{0}: '{1}'".format(macro['name'], macro['definition']))
             mathjax_settings[key] = '{' + ", ".join(text_lines) + '}'
 
+        if key == 'version' and value in (2, 3):
+            mathjax_settings[key] = value
+
+        if key == 'local_source':
+            try:
+                typeVal = isinstance(value, basestring)
+            except NameError:
+                typeVal = isinstance(value, str)
+
+            if not typeVal:
+                continue
+
+            mathjax_settings[key] = value
+
+    if mathjax_settings['version'] == 3:
+        for component in map(_tex_component, tex_extensions):
+            if component is not None and component not in MATHJAX3_BUNDLED_TEX_COMPONENTS + mathjax_settings['tex_components']:
+                mathjax_settings['tex_components'].append(component)
+
+        if mathjax_settings['local_source']:
+            # Served from the same origin as the site (see copy_mathjax_components)
+            mathjax_settings['source'] = "'%s/%s/tex-chtml.js'" % (
+                pelicanobj.settings.get('SITEURL', ''), MATHJAX3_OUTPUT_DIR)
+        else:
+            mathjax_settings['source'] = "'//cdn.jsdelivr.net/npm/mathjax@3/es5/tex-chtml.js'"
+
     return mathjax_settings
 
+# TeX extensions already included in MathJax 3's tex-chtml component
+MATHJAX3_BUNDLED_TEX_COMPONENTS = ['ams', 'autoload', 'base', 'configmacros', 'newcommand', 'noundefined', 'require']
+
+# Directory (relative to the output path) that a local MathJax 3 is copied to
+MATHJAX3_OUTPUT_DIR = 'mathjax'
+
+# MathJax 2 TeX extensions (lower case) and the MathJax 3 TeX extensions
+# that replace them
+MATHJAX3_TEX_COMPONENTS = {
+    'action.js': 'action',
+    'amscd.js': 'amscd',
+    'amsmath.js': 'ams',
+    'amssymbols.js': 'ams',
+    'bbox.js': 'bbox',
+    'boldsymbol.js': 'boldsymbol',
+    'cancel.js': 'cancel',
+    'color.js': 'color',
+    'enclose.js': 'enclose',
+    'extpfeil.js': 'extpfeil',
+    'html.js': 'html',
+    'mhchem.js': 'mhchem',
+    'newcommand.js': 'newcommand',
+    'noerrors.js': 'noerrors',
+    'noundefined.js': 'noundefined',
+    'unicode.js': 'unicode',
+    'verb.js': 'verb',
+}
+
+def _tex_component(extension):
+    """Returns the name of the MathJax 3 TeX extension that corresponds
+    to a MathJax 2 one (e.g. 'AMSsymbols.js' becomes 'ams'), or None
+    if there is no known equivalent"""
+
+    try:
+        return MATHJAX3_TEX_COMPONENTS[extension.lower()]
+    except KeyError:
+        print("\nThe TeX extension %s has no known MathJax 3 equivalent, so it is not loaded when version is set to 3\n" % extension)
+        return None
+
 def _load_macro_definitions(*args):
     """Returns list of lines from files, use absolute path.
 
@@ -335,6 +420,70 @@ def process_summary(article):
 
         article._summary = "%s<script type='text/javascript'>%s</script>" % (summary, process_summary.mathjax_script)
 
+# Math (any tag with the class "math", matched the way Typogrify matches
+# the '.math' selector) and scripts (such as the injected mathjax script)
+MATH_BLOCK_REGEX = re.compile(
+    r"""<([^\s.#<>]+)(?=[^>]*?class\s*=\s*(['"])math\2)[^>]*>.*?</\1>|<(script)[^>]*>.*?</\3>""",
+    re.IGNORECASE | re.DOTALL)
+
+# Placeholder that stands in for math while Typogrify runs. Typogrify
+# filters the text between ignored tags as separate sections, so the
+# placeholder has to look like a section boundary to every filter: the
+# closing </p> acts as the end of a section (widont) and the opening tag
+# as the start of the next one (initial_quotes). Only when needed, since
+# it slows smartypants down, the placeholder also has a space that resets
+# the context smartypants uses to curl a quote that stands on its own
+# after the math
+MATH_PLACEHOLDER = '</p>%s<pmathjaxpelican%d>'
+MATH_PLACEHOLDER_REGEX = re.compile('</p> ?<pmathjaxpelican(\\d+)>')
+
+# Tags that would clash with the placeholder if Typogrify ignored them
+MATH_PLACEHOLDER_TAGS = ['p']
+
+# Tags (other than pre and code) whose text smartypants skips. A placeholder
+# inside one of them would have to close them all to act as a section
+# boundary, which costs more than ignoring the math does
+SMARTYPANTS_SKIPPED_TAG_REGEX = re.compile(r'<(samp|tt|kbd|style|math)\b', re.IGNORECASE)
+
+# A quote that smartypants sees on its own (possibly after some tags)
+LONE_QUOTE_REGEX = re.compile(r"""(<[^>]*>)*(['"]|&quot;)(<|$)""")
+
+def typogrify_with_placeholders(typogrify):
+    """
+    Wraps the typogrify filter so that math and scripts are swapped for
+    placeholders before it runs, and restored afterwards.
+
+    Typogrify then runs once over the whole text, and only has to look
+    for its remaining ignore tags (such as pre and code). The output is
+    the same as ignoring '.math' and 'script' through TYPOGRIFY_IGNORE_TAGS.
+    """
+
+    def typogrify_math(text, ignore_tags=None, **kwargs):
+        ignore_tags = [tag for tag in (ignore_tags or []) if tag not in ('.math', 'script')]
+
+        # Fall back to ignoring math if the placeholders could clash with
+        # the text, if Typogrify would match an ignored tag to them, or if
+        # they would be slower
+        if 'pmathjaxpelican' in text or SMARTYPANTS_SKIPPED_TAG_REGEX.search(text) or any(
+                tag.strip().lower() in MATH_PLACEHOLDER_TAGS
+                or (tag.strip() and 'pmathjaxpelican'.startswith(tag.strip().lower()))
+                for tag in ignore_tags):
+            return typogrify(text, ignore_tags + ['.math', 'script'], **kwargs)
+
+        protected = []
+
+        def protect(match):
+            protected.append(match.group(0))
+            space = ' ' if LONE_QUOTE_REGEX.match(text, match.end()) else ''
+            return MATH_PLACEHOLDER % (space, len(protected) - 1)
+
+        text = typogrify(MATH_BLOCK_REGEX.sub(protect, text), ignore_tags, **kwargs)
+        return MATH_PLACEHOLDER_REGEX.sub(lambda match: protected[int(match.group(1))], text)
+
+    typogrify_math.protects_math = True
+    typogrify_math.original = typogrify
+    return typogrify_math
+
 def configure_typogrify(pelicanobj, mathjax_settings):
     """Instructs Typogrify to ignore math tags - which allows Typogrify
     to play nicely with math related content"""
@@ -350,13 +499,22 @@ def configure_typogrify(pelicanobj, mathjax_settings):
         if LooseVersion(typogrify.__version__) < LooseVersion('2.0.7'):
             raise TypeError('Incorrect version of Typogrify')
 
-        from typogrify.filters import typogrify
+        import typogrify.filters
 
         # At this point, we are happy to use Typogrify, meaning
         # it is installed and it is a recent enough version
         # that can be used to ignore all math
-        # Instantiate markdown extension and append it to the current extensions
-        pelicanobj.settings['TYPOGRIFY_IGNORE_TAGS'].extend(['.math', 'script'])  # ignore math class and script
+        if mathjax_settings['typogrify_placeholders']:
+            # Pelican looks up the filter each time content is read, so
+            # wrapping it here hides math from Typogrify
+            if not getattr(typogrify.filters.typogrify, 'protects_math', False):
+                typogrify.filters.typogrify = typogrify_with_placeholders(typogrify.filters.typogrify)
+        else:
+            # Undo the wrapping if the setting was turned off while autoreloading
+            if getattr(typogrify.filters.typogrify, 'protects_math', False):
+                typogrify.filters.typogrify = typogrify.filters.typogrify.original
+
+            pelicanobj.settings['TYPOGRIFY_IGNORE_TAGS'].extend(['.math', 'script'])  # ignore math class and script
 
     except (ImportError, TypeError) as e:
         pelicanobj.settings['TYPOGRIFY'] = False  # disable Typogrify
@@ -367,15 +525,127 @@ def configure_typogrify(pelicanobj, mathjax_settings):
         if isinstance(e, TypeError):
             print("\nA more recent version of Typogrify is needed for the render_math module.\nPlease upgrade Typogrify to the latest version (anything equal or above version 2.0.7 is okay).\nTypogrify will be turned off due to this reason.\n")
 
+# Script template for each supported major version of MathJax, and the
+# lazy typesetting code that both of them include
+MATHJAX_SCRIPT_TEMPLATES = {2: 'mathjax_script_template', 3: 'mathjax3_script_template'}
+MATHJAX_LAZY_SCRIPT_TEMPLATE = 'mathjax_lazy_script_template'
+
+def _mathjax_script_template_path(template_name):
+    """Returns the absolute path of a mathjax script template"""
+
+    return os.path.dirname(os.path.realpath(__file__)) + '/' + template_name
+
+def mathjax3_settings(mathjax_settings):
+    """Returns a copy of the settings, adapted to the MathJax 3
+    configuration used by the MathJax 3 script template"""
+
+    mathjax_settings = dict(mathjax_settings)
+
+    # The MathJax 2 script evaluates the macros from within a string, so
+    # they carry twice as many backslashes as MathJax 3 needs
+    mathjax_settings['macros'] = mathjax_settings['macros'].replace('\\\\', '\\')
+
+    mathjax_settings['tex_load'] = ','.join(
+        "'[tex]/%s'" % component for component in mathjax_settings['tex_components'])
+    mathjax_settings['tex_packages'] = ','.join(
+        "'%s'" % component for component in mathjax_settings['tex_components'])
+
+    return mathjax_settings
+
 def process_mathjax_script(mathjax_settings):
     """Load the mathjax script template from file, and render with the settings"""
 
+    if mathjax_settings['version'] == 3:
+        mathjax_settings = mathjax3_settings(mathjax_settings)
+
+    # Both versions share the lazy typesetting code, and only differ in
+    # how they typeset (see the script templates)
+    with open(_mathjax_script_template_path(MATHJAX_LAZY_SCRIPT_TEMPLATE), 'r') as lazy_script_template:
+        lazy_script = lazy_script_template.read().rstrip().format(**mathjax_settings)
+    mathjax_settings = dict(mathjax_settings, lazy_script=lazy_script)
+
     # Read the mathjax javascript template from file
-    with open (os.path.dirname(os.path.realpath(__file__))
-            + '/mathjax_script_template', 'r') as mathjax_script_template:
+    with open (_mathjax_script_template_path(MATHJAX_SCRIPT_TEMPLATES[mathjax_settings['version']]), 'r') as mathjax_script_template:
         mathjax_template = mathjax_script_template.read()
     return mathjax_template.format(**mathjax_settings)
 
+def mathjax3_components(mathjax_settings):
+    """Returns the paths (relative to a MathJax 3 es5 directory) of the
+    components the generated script loads"""
+
+    components = ['tex-chtml.js', 'output/chtml/fonts/woff-v2']
+    components.extend('input/tex/extensions/%s.js' % component
+                      for component in mathjax_settings['tex_components'])
+    return components
+
+def _copy_if_modified(source, destination):
+    """Copies a file (or the files in a directory), skipping those that
+    are already up to date at the destination"""
+
+    if os.path.isdir(source):
+        for filename in os.listdir(source):
+            _copy_if_modified(os.path.join(source, filename), os.path.join(destination, filename))
+        return
+
+    if (os.path.exists(destination)
+            and os.path.getmtime(destination) >= os.path.getmtime(source)):
+        return
+
+    if not os.path.isdir(os.path.dirname(destination)):
+        os.makedirs(os.path.dirname(destination))
+    shutil.copy2(source, destination)
+
+def copy_mathjax_components(pelicanobj):
+    """Copies the MathJax 3 components that the site uses from a locally
+    installed MathJax into the output, so that pages load MathJax from
+    the same origin"""
+
+    # Settings as processed by pelican_init
+    mathjax_settings = copy_mathjax_components.mathjax_settings
+    if mathjax_settings is None or mathjax_settings['version'] != 3 or not mathjax_settings['local_source']:
+        return
+
+    output_dir = os.path.join(pelicanobj.settings['OUTPUT_PATH'], MATHJAX3_OUTPUT_DIR)
+    for component in mathjax3_components(mathjax_settings):
+        source = os.path.join(mathjax_settings['local_source'], component)
+        if not os.path.exists(source):
+            print("\nMathJax component %s could not be found in %s\nPages that need it will not render math correctly\n"
+                  % (component, mathjax_settings['local_source']))
+            continue
+
+        _copy_if_modified(source, os.path.join(output_dir, component))
+
+copy_mathjax_components.mathjax_settings = None
+
+def mathjax_watched_files(pelicanobj):
+    """Returns the files that the generated mathjax script depends on,
+    namely the script templates and any user specified macro files"""
+
+    watched_files = [_mathjax_script_template_path(template_name) for template_name
+                     in sorted(MATHJAX_SCRIPT_TEMPLATES.values()) + [MATHJAX_LAZY_SCRIPT_TEMPLATE]]
+
+    try:
+        macros = pelicanobj.settings['MATH_JAX']['macros']
+    except:
+        macros = None
+
+    if isinstance(macros, list):
+        watched_files.extend(macros)
+
+    return watched_files
+
+def _modification_times(files):
+    """Returns a dictionary mapping each file to its modification time
+    (None if the file cannot be accessed)"""
+
+    mtimes = {}
+    for filename in files:
+        try:
+            mtimes[filename] = os.path.getmtime(filename)
+        except OSError:
+            mtimes[filename] = None
+    return mtimes
+
 def mathjax_for_markdown(pelicanobj, mathjax_script, mathjax_settings):
     """Instantiates a customized markdown extension for handling mathjax
     related content"""
@@ -395,15 +665,20 @@ def mathjax_for_markdown(pelicanobj, mathjax_script, mathjax_settings):
             else:
                 pelicanobj.settings['MARKDOWN']['extensions'] = [mathjax]
         elif 'MD_EXTENSIONS' in pelicanobj.settings:
-            pelicanobj.settings['MD_EXTENSIONS'].append(
-                PelicanMathJaxExtension(config))
+            mathjax = PelicanMathJaxExtension(config)
+            pelicanobj.settings['MD_EXTENSIONS'].append(mathjax)
         else:
             raise LookupError("Could not find pelicanobj.settings['MARKDOWN']")
+
+        # Keep a reference so that the script can be swapped on reload
+        mathjax_for_markdown.extension = mathjax
     except:
         sys.excepthook(*sys.exc_info())
         sys.stderr.write("\nError - the pelican mathjax markdown extension failed to configure. MathJax is non-functional.\n")
         sys.stderr.flush()
 
+mathjax_for_markdown.extension = None
+
 def mathjax_for_rst(pelicanobj, mathjax_script):
     """Setup math for RST"""
 
@@ -438,6 +713,69 @@ def pelican_init(pelicanobj):
     if mathjax_settings['process_summary']:
         process_summary.mathjax_script = mathjax_script
 
+    # Set copy_mathjax_components's mathjax_settings variable
+    copy_mathjax_components.mathjax_settings = mathjax_settings
+
+    # Remember what the script was generated from, so that it can be
+    # regenerated if any of these files change (see reload_mathjax)
+    reload_mathjax.mtimes = _modification_times(mathjax_watched_files(pelicanobj))
+    reload_mathjax.mathjax_script = mathjax_script
+    reload_mathjax.reloaded = False
+
+# The mathjax script injected into content, found by the id it gives the
+# MathJax script element (see the script templates)
+MATHJAX_SCRIPT_REGEX = re.compile(
+    r"(<script[^>]*>)(if \(!document\.getElementById\('mathjaxscript_pelican_.*?)(</script>)",
+    re.DOTALL)
+
+def reload_mathjax(pelicanobj):
+    """
+    Regenerates the mathjax settings and script if the script template or
+    a macro file has changed since the last run. This is what makes
+    macro edits show up in autoreload mode without restarting pelican.
+
+    Only the settings and script are regenerated. Content that was
+    generated with an earlier script gets the new one swapped in (see
+    refresh_mathjax_script).
+    """
+
+    mtimes = _modification_times(mathjax_watched_files(pelicanobj))
+    if mtimes == reload_mathjax.mtimes:
+        return
+    reload_mathjax.mtimes = mtimes
+
+    mathjax_settings = process_settings(pelicanobj)
+    mathjax_script = process_mathjax_script(mathjax_settings)
+    if mathjax_script == reload_mathjax.mathjax_script:
+        return
+
+    reload_mathjax.mathjax_script = mathjax_script
+    reload_mathjax.reloaded = True
+
+    if mathjax_for_markdown.extension is not None:
+        mathjax_for_markdown.extension.setConfig('mathjax_script', mathjax_script)
+
+    rst_add_mathjax.mathjax_script = mathjax_script
+
+    if process_summary.mathjax_script is not None:
+        process_summary.mathjax_script = mathjax_script
+
+reload_mathjax.mtimes = {}
+reload_mathjax.mathjax_script = None
+reload_mathjax.reloaded = False
+
+def refresh_mathjax_script(content):
+    """Replaces a stale mathjax script (for instance in content loaded from
+    pelican's cache) with the current one. Only needed once the script has
+    been regenerated, and content without a stale script is untouched"""
+
+    if not reload_mathjax.reloaded or 'mathjaxscript_pelican_' not in content._content:
+        return
+
+    content._content = MATHJAX_SCRIPT_REGEX.sub(
+        lambda match: match.group(1) + reload_mathjax.mathjax_script + match.group(3),
+        content._content)
+
 def rst_add_mathjax(content):
     """Adds mathjax script for reStructuredText"""
 
@@ -465,21 +803,30 @@ def process_rst_and_summaries(content_generators):
 
     Also process summaries if present (only applies to articles)
     and user wants summaries processed (via user settings)
+
+    If the mathjax script was regenerated (see reload_mathjax), any
+    content still carrying the old script is given the new one.
     """
 
     for generator in content_generators:
         if isinstance(generator, generators.ArticlesGenerator):
             for article in generator.articles + generator.translations:
+                refresh_mathjax_script(article)
                 rst_add_mathjax(article)
                 #optionally fix truncated formulae in summaries.
                 if process_summary.mathjax_script is not None:
                     process_summary(article)
         elif isinstance(generator, generators.PagesGenerator):
             for page in generator.pages:
+                refresh_mathjax_script(page)
                 rst_add_mathjax(page)
 
 def register():
     """Plugin registration"""
     signals.initialized.connect(pelican_init)
+    # regenerate the script on every run if its source files changed
+    signals.get_generators.connect(reload_mathjax)
     # repeated
     signals.all_generators_finalized.connect(process_rst_and_summaries)
+    # self host MathJax 3 if requested
+    signals.finalized.connect(copy_mathjax_components)
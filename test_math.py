@@ -1,6 +1,22 @@
+import contextlib
+import io
+import json
 import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 from render_math import parse_tex_macros, _parse_macro, _filter_duplicates
+from render_math import pelican_init, reload_mathjax, rst_add_mathjax
+from render_math import refresh_mathjax_script, mathjax_for_markdown
+from render_math import process_settings, process_mathjax_script
+from render_math import copy_mathjax_components
+from render_math import typogrify_with_placeholders
+
+try:
+    from typogrify.filters import typogrify
+except ImportError:
+    typogrify = None
 
 class TestParseMacros(unittest.TestCase):
     def test_multiple_arguments(self):
@@ -80,5 +96,289 @@ class TestParseMacros(unittest.TestCase):
         self.maxDiff = None
         self.assertEqual(parsed, expected)
 
+class FakePelican(object):
+    def __init__(self, settings):
+        self.settings = settings
+
+class FakeContent(object):
+    def __init__(self, content):
+        self._content = content
+
+class FakeMarkdownExtension(object):
+    """Stands in for PelicanMathJaxExtension, which needs Markdown"""
+    def __init__(self, mathjax_script):
+        self.config = {'mathjax_script': [mathjax_script, 'Mathjax JavaScript script']}
+
+    def getConfig(self, key):
+        return self.config[key][0]
+
+    def setConfig(self, key, value):
+        self.config[key][0] = value
+
+class TestReloadMathJax(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.macro_file = os.path.join(self.tmp_dir, 'macros.tex')
+        with open(self.macro_file, 'w') as macro_file:
+            macro_file.write(r'\newcommand{\bb}{\pi R}')
+        self.pelicanobj = FakePelican({'MATH_JAX': {'macros': [self.macro_file]}})
+        pelican_init(self.pelicanobj)
+
+    def tearDown(self):
+        mathjax_for_markdown.extension = None
+        shutil.rmtree(self.tmp_dir)
+
+    def test_unchanged_macros(self):
+        """Script is not regenerated if no watched file changed"""
+        mathjax_script = rst_add_mathjax.mathjax_script
+        reload_mathjax(self.pelicanobj)
+        self.assertIs(rst_add_mathjax.mathjax_script, mathjax_script)
+        self.assertFalse(reload_mathjax.reloaded)
+
+    def test_changed_macros(self):
+        """Editing a macro file regenerates the script, and content
+        generated with the old script gets the new one"""
+        mathjax_script = rst_add_mathjax.mathjax_script
+        content = FakeContent('<p><span class="math">\\(\\bb\\)</span></p>'
+                              '<script type="text/javascript">%s</script>'
+                              "<script type='text/javascript'>%s</script>"
+                              '<script>var a = 1;</script>' % (mathjax_script, mathjax_script))
+        with open(self.macro_file, 'w') as macro_file:
+            macro_file.write(r'\newcommand{\bb}{\pi r}')
+        os.utime(self.macro_file, (0, 0))
+        reload_mathjax(self.pelicanobj)
+        self.assertIn("bb: '\\\\\\\\pi r'", rst_add_mathjax.mathjax_script)
+        self.assertTrue(reload_mathjax.reloaded)
+
+        refresh_mathjax_script(content)
+        self.assertEqual(content._content,
+                         '<p><span class="math">\\(\\bb\\)</span></p>'
+                         '<script type="text/javascript">%s</script>'
+                         "<script type='text/javascript'>%s</script>"
+                         '<script>var a = 1;</script>' % ((rst_add_mathjax.mathjax_script,) * 2))
+
+    def test_changed_macros_markdown(self):
+        """Editing a macro file hands the new script to the Markdown extension"""
+        mathjax_for_markdown.extension = FakeMarkdownExtension(rst_add_mathjax.mathjax_script)
+        with open(self.macro_file, 'w') as macro_file:
+            macro_file.write(r'\newcommand{\bb}{\pi r}')
+        os.utime(self.macro_file, (0, 0))
+        reload_mathjax(self.pelicanobj)
+        self.assertIn("bb: '\\\\\\\\pi r'", mathjax_for_markdown.extension.getConfig('mathjax_script'))
+        self.assertEqual(mathjax_for_markdown.extension.getConfig('mathjax_script'), rst_add_mathjax.mathjax_script)
+
+@unittest.skipIf(typogrify is None, 'Typogrify is not installed')
+class TestTypogrifyPlaceholders(unittest.TestCase):
+    def setUp(self):
+        self.typogrify_math = typogrify_with_placeholders(typogrify)
+
+    def test_setting_turned_off(self):
+        """Turning the setting off again restores the original filter"""
+        import typogrify.filters
+        original = typogrify.filters.typogrify
+        try:
+            for placeholders in (True, True, False):
+                pelican_init(FakePelican({'TYPOGRIFY': True, 'TYPOGRIFY_IGNORE_TAGS': [],
+                                          'MATH_JAX': {'typogrify_placeholders': placeholders}}))
+                self.assertEqual(getattr(typogrify.filters.typogrify, 'original', None),
+                                 original if placeholders else None)
+        finally:
+            typogrify.filters.typogrify = original
+
+    def test_same_as_ignore_tags(self):
+        """Placeholders give the same output as ignoring math and scripts"""
+        texts = [
+            '<p>"Quote" & AT&T: <span class="math">\\(a -- "b" ... A&B\\)</span>\'s '
+            'value <code>"x" & y</code> ends <span class="math">\\(x\\)</span></p>'
+            '<div class="math">$$E = MC^2 "q"$$</div><p>NASA -- works</p>'
+            '<script type=\'text/javascript\'>var a = "b" -- c;</script>',
+            # math inside blocks that Typogrify ignores anyway
+            '<code>"a" <span class="math">x</span> "b"</code>',
+            '<pre>"a" -- <span class="math">x</span>\n"b" & NASA</pre><p>"c"</p>',
+            '<h1>"a" <span class="math">x</span> "b"</h1><p>"c" & d</p>',
+            # math inside tags that smartypants and caps skip
+            '<p><kbd>"a" <span class="math">x</span> "b"</kbd> "c"</p>',
+            '<p><tt><kbd>NASA <span class="math">x</span> "b"</kbd> "c"</tt> "d"</p>',
+            # text around math is filtered as if the math ended a section
+            '<p>one two <span class="math">x</span></p>',
+            '<p>"<span class="math">x</span>" and "<span class="math">y</span>"</p>',
+            '<li><span class="math">x</span> "quoted" words</li>',
+            '<p>AT&T <span class="math">x</span>& y &<span class=\'math\'>z</span> -- CAPS</p>',
+            '<p><em>"a" <span class="math">x</span></em> b c</p>',
+        ]
+        for ignore_tags in (['.math', 'script'], ['.math', 'script', 'h1'],
+                            ['.math', 'script', 'p'], ['.math', 'script', 'kbd']):
+            for text in texts:
+                self.assertEqual(self.typogrify_math(text, ignore_tags), typogrify(text, ignore_tags))
+
+# Minimal stand-ins for the DOM and MathJax, so that the lazy typesetting
+# in the generated script can be exercised with node instead of a browser
+LAZY_HARNESS = r"""
+var elements = [], batches = [], idle = [], hook = null, observe = null, config = null;
+for (var i = 0; i < 5; i++) elements.push({n: i});
+globalThis.window = globalThis;
+globalThis.screen = {width: 1024};
+globalThis.document = {
+    location: {protocol: 'https:'},
+    body: {appendChild: function (script) { eval(script.text); }},
+    getElementById: function () { return null; },
+    createElement: function () { return {}; },
+    querySelectorAll: function () { return elements; }
+};
+window.requestIdleCallback = function (callback) { idle.push(callback); };
+window.IntersectionObserver = function (callback) {
+    observe = callback;
+    this.observe = function () {};
+    this.unobserve = function () {};
+    this.disconnect = function () {};
+};
+globalThis.MathJax = {Hub: {
+    Config: function (c) { config = c; },
+    Queue: function (command) {
+        batches.push(command[2] ? command[2].map(function (e) { return e.n; }) : 'page');
+        for (var i = 1; i < arguments.length; i++) arguments[i]();
+    },
+    Register: {StartupHook: function (name, callback) { hook = callback; }}
+}};
+%s
+hook();
+observe([{isIntersecting: true, target: elements[3]}, {isIntersecting: false, target: elements[0]}]);
+while (idle.length) idle.shift()();
+console.log(JSON.stringify({skip: config.skipStartupTypeset, batches: batches}));
+"""
+
+# MathJax 3 typesets asynchronously, so the promises are flushed between steps
+LAZY_HARNESS_3 = LAZY_HARNESS.split('globalThis.MathJax')[0] + r"""
+%s
+var config = MathJax;
+var flush = function () { return new Promise(function (resolve) { setTimeout(resolve, 0); }); };
+MathJax = {
+    startup: {promise: Promise.resolve(), defaultReady: function () {}},
+    typesetPromise: function (batch) {
+        batches.push(batch ? batch.map(function (e) { return e.n; }) : 'page');
+        return Promise.resolve();
+    }
+};
+config.startup.ready();
+flush().then(function () {
+    observe([{isIntersecting: true, target: elements[3]}, {isIntersecting: false, target: elements[0]}]);
+    return flush();
+}).then(function drain() {
+    if (!idle.length) return;
+    idle.shift()();
+    return flush().then(drain);
+}).then(function () {
+    console.log(JSON.stringify({skip: !config.startup.typeset, batches: batches}));
+});
+"""
+
+class FakeLazyPelican(object):
+    settings = {'MATH_JAX': {'lazy': True, 'lazy_batch_size': 2}}
+
+class TestLazyTypeset(unittest.TestCase):
+    def test_default_config(self):
+        """Whole page is typeset on load unless lazy is set"""
+        mathjax_script = process_mathjax_script(process_settings(FakePelican({})))
+        self.assertIn("skipStartupTypeset: false", mathjax_script)
+
+    def test_lazy_config(self):
+        mathjax_script = process_mathjax_script(process_settings(FakeLazyPelican()))
+        self.assertIn("skipStartupTypeset: true", mathjax_script)
+        self.assertIn("next + 2", mathjax_script)
+
+    @unittest.skipIf(shutil.which('node') is None, 'node is not installed')
+    def test_lazy_batches(self):
+        """Visible math is typeset first (along with the math above it, so
+        that equations are numbered in order), the rest in batches when idle
+        and finally the whole page"""
+        mathjax_script = process_mathjax_script(process_settings(FakeLazyPelican()))
+        output = subprocess.check_output(['node', '-e', LAZY_HARNESS % mathjax_script])
+        result = json.loads(output.decode('utf-8'))
+        self.assertEqual(result['skip'], True)
+        self.assertEqual(result['batches'], [[0, 1, 2, 3], [4], 'page'])
+
+    @unittest.skipIf(shutil.which('node') is None, 'node is not installed')
+    def test_lazy_batches_version_3(self):
+        """MathJax 3 typesets lazily in the same order"""
+        pelicanobj = FakePelican({'MATH_JAX': {'lazy': True, 'lazy_batch_size': 2, 'version': 3}})
+        mathjax_script = process_mathjax_script(process_settings(pelicanobj))
+        output = subprocess.check_output(['node', '-e', LAZY_HARNESS_3 % mathjax_script])
+        result = json.loads(output.decode('utf-8'))
+        self.assertEqual(result['skip'], True)
+        self.assertEqual(result['batches'], [[0, 1, 2, 3], [4], 'page'])
+
+class TestMathJax3(unittest.TestCase):
+    def setUp(self):
+        cur_dir = os.path.split(os.path.realpath(__file__))[0]
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pelicanobj = FakePelican({
+            'SITEURL': 'https://example.com',
+            'OUTPUT_PATH': os.path.join(self.tmp_dir, 'output'),
+            'MATH_JAX': {'version': 3,
+                         'tex_extensions': ['AMSsymbols.js', 'color.js', 'noErrors.js'],
+                         'macros': [os.path.join(cur_dir, "latex-commands-example.tex")]}})
+
+    def tearDown(self):
+        copy_mathjax_components.mathjax_settings = None
+        shutil.rmtree(self.tmp_dir)
+
+    def test_config(self):
+        """Settings are mapped onto the MathJax 3 configuration"""
+        mathjax_script = process_mathjax_script(process_settings(self.pelicanobj))
+        self.assertIn("load: ['[tex]/noerrors','[tex]/color']", mathjax_script)
+        self.assertIn("packages: { '[+]': ['noerrors','color'] }", mathjax_script)
+        self.assertIn("bb: '\\\\pi R'", mathjax_script)
+        self.assertIn("var source = '//cdn.jsdelivr.net/npm/mathjax@3/es5/tex-chtml.js';", mathjax_script)
+        self.assertNotIn("MathJax.Hub", mathjax_script)
+
+    def test_font_ignored(self):
+        """mathjax_font has no effect, as MathJax 3 only has the TeX font"""
+        mathjax_script = process_mathjax_script(process_settings(self.pelicanobj))
+        self.pelicanobj.settings['MATH_JAX']['mathjax_font'] = 'sanserif'
+        self.assertEqual(process_mathjax_script(process_settings(self.pelicanobj)), mathjax_script)
+
+    def test_unknown_extensions(self):
+        """Extensions without a known MathJax 3 equivalent are not loaded"""
+        self.pelicanobj.settings['MATH_JAX']['tex_extensions'] = ['[Contrib]/physics.js', 'AMScd.js',
+                                                                 'HTML.js', 'autobold.js']
+        mathjax_settings = process_settings(self.pelicanobj)
+        self.assertEqual(mathjax_settings['tex_components'], ['noerrors', 'amscd', 'html'])
+        mathjax_script = process_mathjax_script(mathjax_settings)
+        self.assertIn("load: ['[tex]/noerrors','[tex]/amscd','[tex]/html']", mathjax_script)
+        self.assertNotIn("physics", mathjax_script)
+
+    def test_unknown_extensions_version_2(self):
+        """Extensions are only mapped (and warned about) for MathJax 3"""
+        self.pelicanobj.settings['MATH_JAX']['tex_extensions'] = ['[Contrib]/physics.js', 'autobold.js']
+        self.pelicanobj.settings['MATH_JAX']['version'] = 2
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            mathjax_settings = process_settings(self.pelicanobj)
+        self.assertEqual(output.getvalue(), '')
+        self.assertEqual(mathjax_settings['tex_extensions'], ",'[Contrib]/physics.js','autobold.js'")
+
+    def test_copy_components(self):
+        """Only the components the site uses are copied into the output"""
+        local_source = os.path.join(self.tmp_dir, 'es5')
+        for component in ['tex-chtml.js', 'tex-svg.js', 'output/chtml/fonts/woff-v2/MathJax_Main-Regular.woff',
+                          'input/tex/extensions/color.js', 'input/tex/extensions/noerrors.js',
+                          'input/tex/extensions/mhchem.js']:
+            path = os.path.join(local_source, component)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        self.pelicanobj.settings['MATH_JAX']['local_source'] = local_source
+
+        pelican_init(self.pelicanobj)
+        self.assertIn("var source = 'https://example.com/mathjax/tex-chtml.js';", rst_add_mathjax.mathjax_script)
+
+        copy_mathjax_components(self.pelicanobj)
+        output_dir = os.path.join(self.tmp_dir, 'output', 'mathjax')
+        copied = []
+        for root, _, filenames in os.walk(output_dir):
+            copied.extend(os.path.relpath(os.path.join(root, filename), output_dir) for filename in filenames)
+        self.assertEqual(sorted(copied), ['input/tex/extensions/color.js', 'input/tex/extensions/noerrors.js',
+                                          'output/chtml/fonts/woff-v2/MathJax_Main-Regular.woff', 'tex-chtml.js'])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file